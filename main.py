@@ -1,13 +1,18 @@
 import streamlit as st
-from pypdf import PdfReader
+import ahocorasick
 import os
-import difflib
 from openai import OpenAI
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import InterfaceError, OperationalError
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from pdf_pages import count_pages, extract_page_range, extract_page_ranges
+import bisect
+from contextlib import contextmanager
 import datetime
 import hashlib
 import re
+import tempfile
+import threading
 
 # =========================
 # OpenAI Client
@@ -22,36 +27,129 @@ client = OpenAI(api_key=api_key)
 # =========================
 # Database Setup
 # =========================
-def get_db_connection():
-    return psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=RealDictCursor)
+POOL_MAX_CONN = 10
+
+@st.cache_resource(show_spinner=False)
+def get_pool():
+    pool = ThreadedConnectionPool(
+        1, POOL_MAX_CONN, os.environ["DATABASE_URL"], cursor_factory=RealDictCursor
+    )
+    # ThreadedConnectionPool raises PoolError when exhausted; callers wait on this instead.
+    return pool, threading.BoundedSemaphore(POOL_MAX_CONN)
+
+def _borrow_connection(pool):
+    # Hosted Postgres drops idle connections: ping, and discard dead ones until
+    # the pool hands out a live (or freshly opened) connection.
+    for _ in range(POOL_MAX_CONN + 1):
+        conn = pool.getconn()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            return conn
+        except (OperationalError, InterfaceError):
+            pool.putconn(conn, close=True)
+    raise OperationalError("Could not get a working database connection.")
 
+@contextmanager
+def get_db_connection():
+    # Borrow a pooled connection; commits on success, rolls back on error.
+    pool, slots = get_pool()
+    with slots:
+        conn = _borrow_connection(pool)
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except (OperationalError, InterfaceError):
+            broken = True
+            raise
+        except BaseException:
+            try:
+                conn.rollback()
+            except (OperationalError, InterfaceError):
+                broken = True
+            raise
+        finally:
+            pool.putconn(conn, close=broken or bool(conn.closed))
+
+@st.cache_resource(show_spinner=False)
 def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS study_history (
-            id SERIAL PRIMARY KEY,
-            subject TEXT,
-            query TEXT,
-            response TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    # Schema setup runs once per server process, not on every rerun.
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS study_history (
+                id SERIAL PRIMARY KEY,
+                subject TEXT,
+                query TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
         )
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS textbook_cache (
-            subject TEXT PRIMARY KEY,
-            content TEXT,
-            filename TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        # Responses live in their own table so history listings stay small.
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS study_history_response (
+                id INTEGER PRIMARY KEY REFERENCES study_history (id) ON DELETE CASCADE,
+                response TEXT
+            )
+            """
         )
-        """
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+        # Migrate databases created before the split.
+        cur.execute(
+            """
+            DO $$
+            BEGIN
+                IF EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'study_history' AND column_name = 'response'
+                ) THEN
+                    INSERT INTO study_history_response (id, response)
+                    SELECT id, response FROM study_history
+                    ON CONFLICT (id) DO NOTHING;
+                    ALTER TABLE study_history DROP COLUMN response;
+                END IF;
+            END $$
+            """
+        )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS study_history_query_trgm_idx
+            ON study_history USING gin (query gin_trgm_ops)
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS textbook_cache (
+                subject TEXT PRIMARY KEY,
+                content TEXT,
+                filename TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cur.execute("ALTER TABLE textbook_cache ADD COLUMN IF NOT EXISTS file_hash CHAR(64)")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS textbook_cache_file_hash_idx ON textbook_cache (file_hash)"
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS textbook_chunks (
+                subject TEXT,
+                chunk_id INTEGER,
+                text TEXT,
+                tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', text)) STORED,
+                PRIMARY KEY (subject, chunk_id)
+            )
+            """
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS textbook_chunks_tsv_idx ON textbook_chunks USING gin (tsv)"
+        )
+        cur.close()
 
 init_db()
 
@@ -100,31 +198,185 @@ if not st.session_state.has_access:
 # DB Helpers for History (NEW)
 # =========================
 def save_history(subj, q, r):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO study_history (subject, query, response) VALUES (%s, %s, %s)",
-        (subj, q, r),
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO study_history (subject, query) VALUES (%s, %s) RETURNING id",
+            (subj, q),
+        )
+        record_id = cur.fetchone()["id"]
+        cur.execute(
+            "INSERT INTO study_history_response (id, response) VALUES (%s, %s)",
+            (record_id, r),
+        )
+        cur.close()
 
 def delete_history_record(record_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM study_history WHERE id = %s", (record_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM study_history WHERE id = %s", (record_id,))
+        cur.close()
 
 def clear_history_for_subject(subj: str):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM study_history WHERE subject = %s", (subj,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM study_history WHERE subject = %s", (subj,))
+        cur.close()
+
+# =========================
+# PDF Extraction
+# =========================
+PDF_PARSER = os.environ.get("PDF_PARSER", "pymupdf").lower()
+
+PARALLEL_MIN_PAGES = 64  # below this, process start-up costs more than it saves
+PARALLEL_MEMORY_BUDGET = 512 * 1024 * 1024  # rough cap on PDF bytes open across workers
+
+def _extract_pages_pymupdf(data):
+    n_pages = count_pages(data)
+    workers = min(
+        os.cpu_count() or 1,
+        n_pages // PARALLEL_MIN_PAGES,
+        PARALLEL_MEMORY_BUDGET // max(len(data), 1),
+    )
+    if workers <= 1:
+        yield from extract_page_range(data, 0, n_pages)
+        return
+    step = -(-n_pages // workers)
+    starts = range(0, n_pages, step)
+    stops = [min(start + step, n_pages) for start in starts]
+    # Workers open the PDF from disk instead of each receiving a pickled copy of the bytes.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "textbook.pdf")
+        with open(path, "wb") as f:
+            f.write(data)
+        yield from extract_page_ranges(path, starts, stops, workers)
+
+def _extract_pages_pdfium(data):
+    # Optional fallback for table-heavy textbooks: pip install pypdfium2
+    import pypdfium2 as pdfium
+
+    pdf = pdfium.PdfDocument(data)
+    try:
+        for page in pdf:
+            try:
+                yield page.get_textpage().get_text_range()
+            except Exception:
+                continue
+    finally:
+        pdf.close()
+
+_INLINE_WHITESPACE = re.compile(r"[ \t\f\v]+")
+_PAGE_NUMBER_LINE = re.compile(r"\s*\d+\s*")
+_EXTRA_BLANK_LINES = re.compile(r"\n{3,}")
+
+def normalize_textbook_text(text):
+    # Collapse whitespace and drop page-number-only lines once, at ingestion.
+    text = _INLINE_WHITESPACE.sub(" ", text)
+    text = "\n".join(
+        line.strip() for line in text.split("\n") if not _PAGE_NUMBER_LINE.fullmatch(line)
+    )
+    return _EXTRA_BLANK_LINES.sub("\n\n", text).strip()
+
+def extract_pdf_text(data):
+    if PDF_PARSER == "pypdfium2":
+        pages = _extract_pages_pdfium(data)
+    else:
+        pages = _extract_pages_pymupdf(data)
+    parts = []
+    for page_text in pages:
+        if page_text:
+            parts.append(page_text)
+            parts.append("\n")
+    return normalize_textbook_text("".join(parts))
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_textbook(subj):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT content, filename FROM textbook_cache WHERE subject = %s", (subj,))
+        row = cur.fetchone()
+        cur.close()
+    if not row:
+        return None
+    textbook = dict(row)
+    # Short key for downstream caches, so they never hash the full textbook.
+    textbook["content_hash"] = hashlib.sha256(textbook["content"].encode("utf-8")).hexdigest()
+    return textbook
+
+def find_cached_text_by_hash(file_hash):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT content FROM textbook_cache WHERE file_hash = %s LIMIT 1",
+            (file_hash,),
+        )
+        row = cur.fetchone()
+        cur.close()
+    return row["content"] if row else None
+
+# =========================
+# Textbook Chunks (full-text search)
+# =========================
+CHUNK_MAX_CHARS = 2000  # ~500 tokens
+
+def chunk_text(text, max_chars=CHUNK_MAX_CHARS):
+    # Pack paragraphs into chunks; fall back to lines, then hard splits, for oversized blocks.
+    pieces = []
+    for para in text.split("\n\n"):
+        if len(para) <= max_chars:
+            pieces.append(para)
+            continue
+        for line in para.split("\n"):
+            for i in range(0, len(line), max_chars):
+                pieces.append(line[i:i + max_chars])
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if not piece.strip():
+            continue
+        if current and len(current) + len(piece) + 2 > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def save_textbook_chunks(cur, subj, text):
+    cur.execute("DELETE FROM textbook_chunks WHERE subject = %s", (subj,))
+    execute_values(
+        cur,
+        "INSERT INTO textbook_chunks (subject, chunk_id, text) VALUES %s",
+        [(subj, i, chunk) for i, chunk in enumerate(chunk_text(text))],
+    )
+
+def search_textbook_chunks(subj, search_terms, limit=20):
+    terms = [term for term in search_terms if term]
+    if not terms:
+        return []
+    # OR of one plainto_tsquery per term, so user text is never parsed as query syntax.
+    tsquery_sql = " || ".join(["plainto_tsquery('simple', %s)"] * len(terms))
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        # Top chunks by rank, returned in textbook order for the prompt.
+        cur.execute(
+            f"""
+            SELECT text FROM (
+                SELECT chunk_id, text, ts_rank(tsv, q) AS rank
+                FROM textbook_chunks, (SELECT {tsquery_sql} AS q) AS query
+                WHERE subject = %s AND tsv @@ q
+                ORDER BY rank DESC
+                LIMIT %s
+            ) AS top
+            ORDER BY chunk_id
+            """,
+            (*terms, subj, limit),
+        )
+        rows = cur.fetchall()
+        cur.close()
+    return [row["text"] for row in rows]
 
 # =========================
 # Sidebar: Subject + Textbook Upload/Cache
@@ -137,26 +389,23 @@ with st.sidebar:
          "Chemistry", "Physics", "Biology", "History", "Other"]
     )
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT content, filename FROM textbook_cache WHERE subject = %s", (subject,))
-    cached = cur.fetchone()
-    cur.close()
-    conn.close()
+    cached = load_textbook(subject)
 
     textbook_content = None
+    textbook_hash = None
 
     if cached:
         st.success(f"Loaded cached textbook: {cached['filename']}")
         if st.button("Delete Cached Textbook"):
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("DELETE FROM textbook_cache WHERE subject = %s", (subject,))
-            conn.commit()
-            cur.close()
-            conn.close()
+            with get_db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("DELETE FROM textbook_cache WHERE subject = %s", (subject,))
+                cur.execute("DELETE FROM textbook_chunks WHERE subject = %s", (subject,))
+                cur.close()
+            load_textbook.clear()
             st.rerun()
         textbook_content = cached["content"]
+        textbook_hash = cached["content_hash"]
         uploaded_file = True  # your original flag for logic
     else:
         uploaded_file = st.file_uploader(
@@ -169,33 +418,34 @@ with st.sidebar:
                 st.stop()
 
             with st.spinner("Extracting and caching textbook..."):
-                reader = PdfReader(uploaded_file)
-                text = ""
-                for page in reader.pages:
-                    try:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-                    except Exception:
-                        continue
-
-                conn = get_db_connection()
-                cur = conn.cursor()
-                cur.execute(
-                    """
-                    INSERT INTO textbook_cache (subject, content, filename)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (subject)
-                    DO UPDATE SET
-                        content = EXCLUDED.content,
-                        filename = EXCLUDED.filename,
-                        timestamp = CURRENT_TIMESTAMP
-                    """,
-                    (subject, text, uploaded_file.name),
-                )
-                conn.commit()
-                cur.close()
-                conn.close()
+                # Hash in 1 MB reads; file_digest/getbuffer() would force BytesIO to copy the upload.
+                hasher = hashlib.sha256()
+                while chunk := uploaded_file.read(1 << 20):
+                    hasher.update(chunk)
+                file_hash = hasher.hexdigest()
+                uploaded_file.seek(0)
+                text = find_cached_text_by_hash(file_hash)
+                if text is None:
+                    text = extract_pdf_text(uploaded_file.getvalue())
+
+                with get_db_connection() as conn:
+                    cur = conn.cursor()
+                    cur.execute(
+                        """
+                        INSERT INTO textbook_cache (subject, content, filename, file_hash)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (subject)
+                        DO UPDATE SET
+                            content = EXCLUDED.content,
+                            filename = EXCLUDED.filename,
+                            file_hash = EXCLUDED.file_hash,
+                            timestamp = CURRENT_TIMESTAMP
+                        """,
+                        (subject, text, uploaded_file.name, file_hash),
+                    )
+                    save_textbook_chunks(cur, subject, text)
+                    cur.close()
+                load_textbook.clear()
 
                 textbook_content = text
                 st.success("PDF Cached!")
@@ -209,222 +459,298 @@ if not (cached or (locals().get("uploaded_file") and not isinstance(uploaded_fil
 # =========================
 # Sidebar: History + Delete Controls (NEW)
 # =========================
-with st.sidebar:
-    st.divider()
-    st.header("🕒 Study History")
-
+@st.fragment
+def history_panel(subj):
     # NEW: Clear history for this subject
     if st.button("🧹 Clear ALL history (this subject)", use_container_width=True):
-        clear_history_for_subject(subject)
+        clear_history_for_subject(subj)
         if "current_history_id" in st.session_state:
             del st.session_state["current_history_id"]
         st.success("Cleared.")
         st.rerun()
 
     # Load recent history
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, query, timestamp FROM study_history WHERE subject = %s ORDER BY timestamp DESC LIMIT 10",
-        (subject,),
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT id, query, timestamp FROM study_history WHERE subject = %s ORDER BY timestamp DESC LIMIT 10",
+            (subj,),
+        )
+        history = cur.fetchall()
+        cur.close()
+
+    # One selector + view/delete actions instead of a button pair per record
+    labels = {h["id"]: f"{h['timestamp'].strftime('%m-%d %H:%M')}: {h['query'][:20]}..." for h in history}
+    selected_id = st.selectbox(
+        "Recent records",
+        options=list(labels),
+        format_func=labels.get,
+        index=None,
+        placeholder="Select a record",
+        key=f"hist_select_{subj}",
     )
-    history = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    # NEW: view + delete per item
-    for h in history:
-        c1, c2 = st.columns([0.78, 0.22])
-        label = f"{h['timestamp'].strftime('%m-%d %H:%M')}: {h['query'][:20]}..."
-        with c1:
-            if st.button(label, key=f"hist_view_{h['id']}", use_container_width=True):
-                st.session_state.current_history_id = h["id"]
-        with c2:
-            if st.button("🗑️", key=f"hist_del_{h['id']}", help="Delete this record", use_container_width=True):
-                delete_history_record(int(h["id"]))
-                # If user deleted the currently opened record, clear selection
-                if st.session_state.get("current_history_id") == h["id"]:
-                    del st.session_state["current_history_id"]
-                st.rerun()
+    c1, c2 = st.columns([0.78, 0.22])
+    with c1:
+        if st.button("View", key="hist_view", disabled=selected_id is None, use_container_width=True):
+            st.session_state.current_history_id = selected_id
+            # The detail view lives in another tab, so this needs a full-app rerun.
+            st.rerun()
+    with c2:
+        if st.button("🗑️", key="hist_del", disabled=selected_id is None, help="Delete this record", use_container_width=True):
+            delete_history_record(int(selected_id))
+            # If user deleted the currently opened record, clear selection
+            if st.session_state.get("current_history_id") == selected_id:
+                del st.session_state["current_history_id"]
+            st.rerun()
+
+with st.sidebar:
+    st.divider()
+    st.header("🕒 Study History")
+    history_panel(subject)
 
 # =========================
 # AI
 # =========================
-@st.cache_data
-def get_ai_response(prompt, context, subject_name, allow_external=False):
+CHAPTER_PATTERN = re.compile(r"\b\d+\.\d+\b")
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def index_textbook(subject_name, content_hash, _content):
+    # Split + lowercase once per textbook; cache_resource avoids copying the lists per call.
+    lines = _content.split("\n")
+    lowered = [line.lower() for line in lines]
+    # Start offset of each line inside lowered_text, for mapping match offsets back to lines.
+    line_starts = []
+    offset = 0
+    for line in lowered:
+        line_starts.append(offset)
+        offset += len(line) + 1
+    return lines, "\n".join(lowered), line_starts
+
+def find_matching_lines(lowered_text, line_starts, search_terms):
+    automaton = ahocorasick.Automaton()
+    for term in search_terms:
+        term = term.lower()
+        if term:
+            automaton.add_word(term, term)
+    if len(automaton) == 0:
+        return []
+    automaton.make_automaton()
+    return sorted(
+        {bisect.bisect_right(line_starts, end) - 1 for end, _ in automaton.iter(lowered_text)}
+    )
+
+@st.cache_data(show_spinner=False)
+def build_ai_messages(prompt, context_hash, subject_name, allow_external=False, *, _context):
+    # Cache key uses context_hash; the textbook itself (_context) is not hashed by Streamlit.
+    prev_match = None
+    context_limit = 40000
+
+    # --- Memory System: check similar previous queries (pg_trgm, indexed) ---
     try:
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SET LOCAL pg_trgm.similarity_threshold = 0.4")
+            cur.execute(
+                """
+                SELECT h.query, r.response
+                FROM study_history h
+                JOIN study_history_response r ON r.id = h.id
+                WHERE h.subject = %s AND h.query %% %s
+                ORDER BY similarity(h.query, %s) DESC
+                LIMIT 1
+                """,
+                (subject_name, prompt, prompt),
+            )
+            prev_match = cur.fetchone()
+            cur.close()
+    except Exception:
         prev_match = None
-        context_limit = 40000
 
-        # --- Memory System: check similar previous queries ---
+    prev_context = ""
+    if prev_match:
+        prev_context = f"\nPREVIOUS RELATED ANSWER (for '{prev_match['query']}'):\n{prev_match['response']}\n"
+        context_limit = 10000
+
+    # --- Improved RAG snippet selection ---
+    chapter_patterns = CHAPTER_PATTERN.findall(prompt)
+    keywords = [w.strip(".,?!()") for w in prompt.split() if len(w) > 3]
+    search_terms = list(set(chapter_patterns + keywords))
+
+    relevant_snippets = []
+    if search_terms:
         try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT query, response FROM study_history WHERE subject = %s", (subject_name,))
-            rows = cur.fetchall()
-            cur.close()
-            conn.close()
-
-            best_score = 0.0
-            best_query = None
-            best_response = None
-
-            for row in rows:
-                try:
-                    # RealDictCursor => row is dict-like
-                    q = row["query"]
-                    score = difflib.SequenceMatcher(None, prompt, q).ratio()
-                    if score > best_score:
-                        best_score = score
-                        best_query = q
-                        best_response = row["response"]
-                except Exception:
-                    continue
-
-            if best_score > 0.4 and best_query is not None:
-                prev_match = {"query": best_query, "response": best_response}
+            relevant_snippets = search_textbook_chunks(subject_name, search_terms)
         except Exception:
-            prev_match = None
-
-        prev_context = ""
-        if prev_match:
-            prev_context = f"\nPREVIOUS RELATED ANSWER (for '{prev_match['query']}'):\n{prev_match['response']}\n"
-            context_limit = 10000
-
-        # --- Improved RAG snippet selection ---
-        chapter_patterns = re.findall(r"\b\d+\.\d+\b", prompt)
-        keywords = [w.strip(".,?!()") for w in prompt.split() if len(w) > 3]
-        search_terms = list(set(chapter_patterns + keywords))
-
-        relevant_snippets = []
-        if search_terms:
-            lines = context.split("\n")
-            for i, line in enumerate(lines):
-                if any(re.search(re.escape(term), line, re.IGNORECASE) for term in search_terms):
-                    start = max(0, i - 30)
-                    end = min(len(lines), i + 50)
-                    relevant_snippets.append("\n".join(lines[start:end]))
-
-        if not relevant_snippets:
-            context_snippet = (context[:20000] + "\n... [SNIP] ...\n" + context[-10000:])[:context_limit]
-        else:
-            unique_snippets = list(set(relevant_snippets))
-            joined_snippets = "\n--- SECTION START ---\n".join(unique_snippets)
-            context_snippet = joined_snippets[:context_limit]
-
-        external_instruction = ""
-        if allow_external:
-            external_instruction = (
-                "If the textbook context is insufficient, you MAY use external knowledge "
-                "but MUST explicitly state '【注：以下内容来源于外部资料，非教材原话】'."
-            )
+            relevant_snippets = []
+
+    # Fallback: in-memory line scan (textbooks cached before chunking, or CJK text
+    # that the 'simple' text-search config does not split into words).
+    if search_terms and not relevant_snippets:
+        lines, lowered_text, line_starts = index_textbook(subject_name, context_hash, _context)
+        # Merge overlapping windows around hits so each textbook line is sent at most once.
+        merged = []
+        for i in find_matching_lines(lowered_text, line_starts, search_terms):
+            start = max(0, i - 30)
+            end = min(len(lines), i + 50)
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        relevant_snippets = ["\n".join(lines[start:end]) for start, end in merged]
+
+    if not relevant_snippets:
+        context_snippet = (_context[:20000] + "\n... [SNIP] ...\n" + _context[-10000:])[:context_limit]
+    else:
+        joined_snippets = "\n--- SECTION START ---\n".join(relevant_snippets)
+        context_snippet = joined_snippets[:context_limit]
+
+    external_instruction = ""
+    if allow_external:
+        external_instruction = (
+            "If the textbook context is insufficient, you MAY use external knowledge "
+            "but MUST explicitly state '【注：以下内容来源于外部资料，非教材原话】'."
+        )
+
+    return [
+        {
+            "role": "system",
+            "content": (
+                f"You are an expert IB {subject_name} tutor. {external_instruction} "
+                "Use the provided context and any previous related answers to refine your response. "
+                "If a previous answer is provided, improve upon it rather than repeating it."
+            ),
+        },
+        {
+            "role": "user",
+            "content": f"HIERARCHICAL CONTEXT FROM TEXTBOOK:\n{context_snippet}\n{prev_context}\n\nUSER REQUEST: {prompt}",
+        },
+    ]
+
+def get_ai_response(prompt, context_hash, subject_name, allow_external=False, *, _context, history_query):
+    # Renders the answer, streaming it the first time. A fresh answer is saved to history
+    # once and kept per session, so reruns redisplay it without a new API call or save.
+    responses = st.session_state.setdefault("ai_responses", {})
+    key = (prompt, context_hash, subject_name, allow_external)
+    if key in responses:
+        st.markdown(responses[key])
+        return responses[key]
 
-        response = client.chat.completions.create(
-            model="gpt-5",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        f"You are an expert IB {subject_name} tutor. {external_instruction} "
-                        "Use the provided context and any previous related answers to refine your response. "
-                        "If a previous answer is provided, improve upon it rather than repeating it."
-                    ),
-                },
-                {
-                    "role": "user",
-                    "content": f"HIERARCHICAL CONTEXT FROM TEXTBOOK:\n{context_snippet}\n{prev_context}\n\nUSER REQUEST: {prompt}",
-                },
-            ],
+    try:
+        messages = build_ai_messages(
+            prompt, context_hash, subject_name, allow_external, _context=_context
+        )
+        stream = client.chat.completions.create(model="gpt-5", messages=messages, stream=True)
+        result = st.write_stream(
+            chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices
         )
-        return response.choices[0].message.content
     except Exception as e:
-        return f"Error: {str(e)}"
+        result = f"Error: {str(e)}"
+        st.markdown(result)
+        return result
+
+    responses[key] = result
+    save_history(subject_name, history_query, result)
+    # Tabs are fragments; rerun the whole app so the sidebar history shows the new record.
+    st.rerun()
 
 # =========================
 # Tabs
 # =========================
-tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(
-    ["💡 简化解释", "📑 完整理论", "🌍 案例/实验/应用", "📝 考试复习笔记", "💬 智能问答", "📜 历史详情"]
-)
-
-with tab1:
-    st.header(f"💡 {subject} 简化解释")
+@st.fragment
+def tab_simple(subj, content, content_hash):
+    st.header(f"💡 {subj} 简化解释")
     topic = st.text_input("知识点", key="topic_simple")
     if topic:
         with st.spinner("整理中..."):
             prompt = f"中英双语解释 '{topic}'。中文讲逻辑，英文留术语。禁止 LaTeX。"
-            result = get_ai_response(prompt, textbook_content, subject)
-            save_history(subject, f"简化解释: {topic}", result)
-            st.markdown(result)
+            get_ai_response(
+                prompt, content_hash, subj, _context=content, history_query=f"简化解释: {topic}"
+            )
 
-with tab2:
-    st.header(f"📑 {subject} 完整理论")
+@st.fragment
+def tab_theory(subj, content, content_hash):
+    st.header(f"📑 {subj} 完整理论")
     topic = st.text_input("理论概念", key="topic_theory")
     if topic:
         with st.spinner("生成中..."):
             prompt = f"提供 '{topic}' 的 IB 考试级理论。主体全英文，关键点中文注解。"
-            result = get_ai_response(prompt, textbook_content, subject)
-            save_history(subject, f"理论: {topic}", result)
-            st.markdown(result)
+            get_ai_response(prompt, content_hash, subj, _context=content, history_query=f"理论: {topic}")
 
-with tab3:
-    st.header(f"🌍 {subject} 案例/实验")
+@st.fragment
+def tab_example(subj, content, content_hash):
+    st.header(f"🌍 {subj} 案例/实验")
     topic = st.text_input("案例知识点", key="topic_example")
     if topic:
         with st.spinner("查找中..."):
             prompt = f"提供 2-3 个关于 '{topic}' 的英文案例/实验，配中文背景说明。"
-            result = get_ai_response(prompt, textbook_content, subject)
-            save_history(subject, f"案例: {topic}", result)
-            st.markdown(result)
+            get_ai_response(prompt, content_hash, subj, _context=content, history_query=f"案例: {topic}")
 
-with tab4:
-    st.header(f"📝 {subject} 详细复习笔记")
+@st.fragment
+def tab_notes(subj, content, content_hash):
+    st.header(f"📝 {subj} 详细复习笔记")
     st.write("请粘贴您的考试大纲、考题要求或想复习的具体内容，AI 将结合教材为您生成详细的复习笔记。")
     exam_content = st.text_area("考纲/题目要求", height=200)
     if st.button("生成详细笔记"):
         if exam_content:
-            with st.spinner("深度扫描并生成极其详尽的笔记..."):
-                prompt = (
-                    "根据教材，为以下大纲生成极其详尽、无遗漏的复习笔记：\n"
-                    f"{exam_content}\n\n要求：\n"
-                    "1. 必须深入到教材的每一个层级（大标题、小标题、子要点）；\n"
-                    "2. 包含教材中提到的所有定义、公式推导、图表逻辑和具体示例；\n"
-                    "3. 结构严谨，体现知识的层级分支（不要简略概括）；\n"
-                    "4. 采用中英双语，英文术语必须准确；\n"
-                    "5. 教材不足处以外源资料补充并标注。"
-                )
-                result = get_ai_response(prompt, textbook_content, subject, allow_external=True)
-                save_history(subject, f"复习笔记: {exam_content[:30]}...", result)
-                st.markdown(result)
+            st.session_state.notes_request = exam_content
         else:
+            st.session_state.pop("notes_request", None)
             st.warning("请先输入考试内容。")
 
-with tab5:
-    st.header(f"💬 {subject} 智能问答")
+    # Kept in session_state so the notes survive the rerun that follows a new answer.
+    notes_request = st.session_state.get("notes_request")
+    if notes_request:
+        with st.spinner("深度扫描并生成极其详尽的笔记..."):
+            prompt = (
+                "根据教材，为以下大纲生成极其详尽、无遗漏的复习笔记：\n"
+                f"{notes_request}\n\n要求：\n"
+                "1. 必须深入到教材的每一个层级（大标题、小标题、子要点）；\n"
+                "2. 包含教材中提到的所有定义、公式推导、图表逻辑和具体示例；\n"
+                "3. 结构严谨，体现知识的层级分支（不要简略概括）；\n"
+                "4. 采用中英双语，英文术语必须准确；\n"
+                "5. 教材不足处以外源资料补充并标注。"
+            )
+            get_ai_response(
+                prompt,
+                content_hash,
+                subj,
+                allow_external=True,
+                _context=content,
+                history_query=f"复习笔记: {notes_request[:30]}...",
+            )
+
+@st.fragment
+def tab_qa(subj, content, content_hash):
+    st.header(f"💬 {subj} 智能问答")
     user_query = st.text_input("问题", key="user_qa")
     if user_query:
         with st.spinner("思考中..."):
-            result = get_ai_response(user_query, textbook_content, subject, allow_external=True)
-            save_history(subject, user_query, result)
             st.write("---")
-            st.markdown(result)
+            get_ai_response(
+                user_query, content_hash, subj, allow_external=True, _context=content, history_query=user_query
+            )
 
-with tab6:
+@st.fragment
+def tab_history():
     st.header("📜 历史查看")
 
     # NEW: delete currently selected history record
     if "current_history_id" in st.session_state:
         record_id = st.session_state.current_history_id
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, query, response, timestamp FROM study_history WHERE id = %s",
-            (record_id,),
-        )
-        record = cur.fetchone()
-        cur.close()
-        conn.close()
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT h.id, h.query, r.response, h.timestamp
+                FROM study_history h
+                LEFT JOIN study_history_response r ON r.id = h.id
+                WHERE h.id = %s
+                """,
+                (record_id,),
+            )
+            record = cur.fetchone()
+            cur.close()
 
         if record:
             c1, c2 = st.columns([0.85, 0.15])
@@ -438,10 +764,32 @@ with tab6:
                     st.success("已删除")
                     st.rerun()
 
-            st.markdown(record["response"])
+            st.markdown(record["response"] or "")
         else:
             st.info("这条记录不存在或已被删除。")
             del st.session_state["current_history_id"]
             st.rerun()
     else:
         st.info("在左侧点击历史记录进行查看。")
+
+tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(
+    ["💡 简化解释", "📑 完整理论", "🌍 案例/实验/应用", "📝 考试复习笔记", "💬 智能问答", "📜 历史详情"]
+)
+
+with tab1:
+    tab_simple(subject, textbook_content, textbook_hash)
+
+with tab2:
+    tab_theory(subject, textbook_content, textbook_hash)
+
+with tab3:
+    tab_example(subject, textbook_content, textbook_hash)
+
+with tab4:
+    tab_notes(subject, textbook_content, textbook_hash)
+
+with tab5:
+    tab_qa(subject, textbook_content, textbook_hash)
+
+with tab6:
+    tab_history()
@@ -0,0 +1,59 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import sys
+
+import fitz  # PyMuPDF
+
+# Kept outside main.py so process-pool workers can import it without
+# re-running the Streamlit script.
+
+def _open(source):
+    # source is either the PDF bytes or a path; a path lets MuPDF load pages lazily.
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source, filetype="pdf")
+
+def count_pages(source):
+    doc = _open(source)
+    try:
+        return doc.page_count
+    finally:
+        doc.close()
+
+def extract_page_range(source, start, stop):
+    # PyMuPDF is not thread-safe, so each worker process opens its own document.
+    doc = _open(source)
+    texts = []
+    try:
+        for i in range(start, stop):
+            try:
+                texts.append(doc[i].get_text("text"))
+            except Exception:
+                continue
+    finally:
+        doc.close()
+    return texts
+
+def _worker_context():
+    # Never fork the multi-threaded Streamlit server.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+def extract_page_ranges(path, starts, stops, workers):
+    # Streamlit installs the running script as sys.modules["__main__"], which spawn and
+    # forkserver children would re-execute on start-up. Point __main__ at this module
+    # while the workers launch so they only import pdf_pages.
+    script_main = sys.modules["__main__"]
+    sys.modules["__main__"] = sys.modules[__name__]
+    try:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=_worker_context())
+        futures = [
+            executor.submit(extract_page_range, path, start, stop)
+            for start, stop in zip(starts, stops)
+        ]
+    finally:
+        sys.modules["__main__"] = script_main
+    with executor:
+        for future in futures:
+            yield from future.result()